@@ -17,16 +17,10 @@ from remotepspy.simple_command_tracer import SimpleCommandTracer
 
 
 def get_svchost_pids():
-    svchost_procs = []
-    for proc in psutil.process_iter():
-        try:
-            pinfo = proc.as_dict(attrs=['pid', 'name'])
-        except psutil.NoSuchProcess:
-            pass
-        else:
-            if pinfo['name'] == 'svchost.exe':
-                svchost_procs.append(pinfo['pid'])
-    return svchost_procs
+    # Passing attrs to process_iter() fetches just those attributes for each process, and silently skips processes
+    # that have exited in the meantime.
+    return [proc.info['pid'] for proc in psutil.process_iter(attrs=['pid', 'name'])
+            if proc.info['name'] == 'svchost.exe']
 
 
 def init_logging():
@@ -95,6 +89,7 @@ def run_powershell_etw():
     etw_job = ETWPowerShell(session_name='PSRP_monitor', event_callback=psetwparse.new_event, include_pids=svchost_pids)
 
     try:
+        psetwparse.start()
         etw_job.start()
         print('\nPress ENTER or CTRL+C to stop trace\n')
         input()
@@ -103,6 +98,7 @@ def run_powershell_etw():
     finally:
         if etw_job.running:
             etw_job.stop()
+        psetwparse.stop()
 
 
 def main():
@@ -1,99 +1,184 @@
 import logging
 import threading
 import traceback
+import binascii
+import queue
 
 import etw
 
 
 class PowerShellETWParser:
-    """Parses PowerShell ETW events to identify Shell context and PSRP fragments. Also provides thread synchronisation.
+    """Parses PowerShell ETW events to identify Shell context and PSRP fragments. Events are queued as they arrive and
+    parsed on a dedicated worker thread, so the ETW callback returns as quickly as possible and events are handled one
+    at a time in the order they were received.
     """
 
     LOGGER_NAME = 'RemotePSpy.PowerShellETWParser'
 
+    KEYWORD_PSRP_FRAGMENT = 0x4000000000000008
+    KEYWORD_SHELL_CONTEXT = 0x4000000000000100
+
     def __init__(self, completed_callback):
         self.logger = logging.getLogger(PowerShellETWParser.LOGGER_NAME)
-        self.lock = threading.Lock()
+        self.events = queue.SimpleQueue()
+        self.worker = None
         self.completed_callback = completed_callback
-        self.shells = []
+        self.shells = set()
+        # Maps ActivityID to the shell_id it relates to
         self.activity_shell_contexts = {}
+        # Reverse of activity_shell_contexts, mapping a shell_id to the set of its ActivityIDs, so that all tracking for
+        # a shell can be removed without scanning every tracked activity.
+        self.shell_activities = {}
+        # Caches the handler for each shell context event type, keyed by (Id, Version) from the EventDescriptor
+        self.shell_context_handlers = {}
+        # Event handlers keyed by (Keyword, Level). A Level of None matches events of any level for that Keyword.
+        # Only level 5 events from the PSRP fragment keyword contain PSRP fragments, others from it are skipped.
+        self.event_handlers = {
+            (PowerShellETWParser.KEYWORD_PSRP_FRAGMENT, 5): self._psrp_frag_event,
+            (PowerShellETWParser.KEYWORD_SHELL_CONTEXT, None): self._shell_context_event,
+        }
+
+    # Start the worker thread which parses queued events. Should be called before the ETW session is started.
+    def start(self):
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self._process_events, name='PowerShellETWParser', daemon=True)
+        self.worker.start()
 
-    # Accepts a new Microsoft-Windows-PowerShell event and readies it for being passed to the PSRPDefragmenter via
-    # completed_callback
+    # Stop the worker thread once any events already queued have been parsed.
+    def stop(self):
+        if self.worker is None:
+            return
+        self.events.put(None)
+        self.worker.join()
+        self.worker = None
+
+    # Accepts a new Microsoft-Windows-PowerShell event and queues it to be readied for passing to the PSRPDefragmenter
+    # via completed_callback
     def new_event(self, event_tuple):
+        self.events.put(event_tuple)
+
+    def _process_events(self):
+        while True:
+            event_tuple = self.events.get()
+            if event_tuple is None:
+                break
+            self._process_event(event_tuple)
+
+    def _process_event(self, event_tuple):
         event_id, event = event_tuple
-        with self.lock:
-            try:
-                if (event['EventHeader']['EventDescriptor']['Keyword'] == 0x4000000000000008
-                        and event['EventHeader']['EventDescriptor']['Level'] == 5):
-                    # Skip events from keyword 0x4000000000000008 which are not level 5. The non-level 5 events do not
-                    # contain PSRP fragments.
-                    self._psrp_frag_event(event)
-                elif event['EventHeader']['EventDescriptor']['Keyword'] == 0x4000000000000100:
-                    self._shell_context_event(event)
-            except Exception:
-                tb = traceback.format_exc()
-                self.logger.error('PowerShellETWParser error: event: {} | Exception info: {}'.format(event, tb))
-
-    def _psrp_frag_event(self, event):
+        try:
+            header = event['EventHeader']
+            descriptor = header['EventDescriptor']
+            keyword = descriptor['Keyword']
+            handler = self.event_handlers.get((keyword, descriptor['Level']))
+            if handler is None:
+                handler = self.event_handlers.get((keyword, None))
+            if handler is not None:
+                handler(event, header)
+        except Exception:
+            tb = traceback.format_exc()
+            self.logger.error('PowerShellETWParser error: event: {} | Exception info: {}'.format(event, tb))
+
+    def _psrp_frag_event(self, event, header):
         # Get some useful header details
-        activity_id = None
-        if 'ActivityId' in event['EventHeader']:
-            activity_id = event['EventHeader']['ActivityId']
-        pid = event['EventHeader']['ProcessId']
-        tid = event['EventHeader']['ThreadId']
+        activity_id = header.get('ActivityId')
+        pid = header['ProcessId']
+        tid = header['ThreadId']
         # Get relevant payload data
         object_id = event['ObjectId']
         fragment_id = int(event['FragmentId'])
         s_flag = event['sFlag']
         e_flag = event['eFlag']
         frag_len = event['FragmentLength']
-        frag_data = event['FragmentPayload']  # Is in the form of a long hex string like '0x0102....'
-        frag_data = bytes.fromhex(frag_data[2:])
-        # Identify the Shell context of this PSRP fragment
-        if activity_id not in self.activity_shell_contexts:
+        # Identify the Shell context of this PSRP fragment (before decoding the payload, which is wasted otherwise)
+        shell_id = self.activity_shell_contexts.get(activity_id)
+        if shell_id is None:
             self.logger.error('Unable to identify Shell context for PSRP fragment: {}'.format(event))
             return
-        shell_id = self.activity_shell_contexts[activity_id]
+        # Usually in the form of a long hex string like '0x0102....', but may already be raw bytes
+        frag_data = PowerShellETWParser._decode_fragment_payload(event['FragmentPayload'])
         self.completed_callback(shell_id, object_id, fragment_id, s_flag, e_flag, frag_len, frag_data)
 
+    # Decode a '0x' prefixed hex string, as used for FragmentPayload. binascii.a2b_hex() is stricter than
+    # bytes.fromhex() (no whitespace skipping) and so decodes noticeably faster on large payloads.
+    # pywintrace renders binary fields as hex via TDH, but if the payload is ever delivered as a raw buffer it is used
+    # directly rather than making a round trip through a hex string.
+    @staticmethod
+    def _decode_fragment_payload(payload):
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            return payload
+        return binascii.a2b_hex(payload[2:])
+
     # NOTE: it would be possible to also get Command IDs from here, as they get associated with request IDs, but we
     # probably don't need CommandID after all.
-    def _shell_context_event(self, event):
-        if 'ActivityId' not in event['EventHeader']:
+    def _shell_context_event(self, event, header):
+        activity_id = header.get('ActivityId')
+        if activity_id is None:
             return  # Cannot add shell context if there is no ActivityID to go on
-        activity_id = event['EventHeader']['ActivityId']
-        # A new shell context has been created
-        if 'Request %1. Creating a server remote session.' in event['Description']:
-            # Context for a newly created shell
-            shell_id = event['param1']
-            username = event['param2']  # TODO add user context to the tracked shell
-            self.logger.debug('Tracking new shell {} against ActivityID: {}'.format(shell_id, activity_id))
-            if shell_id not in self.shells:
-                self.shells.append(shell_id)
-            self.activity_shell_contexts[activity_id] = shell_id
-        # Identify shell context for an existing shell
-        elif 'Shell Context %1. Request Id %2' in event['Description']:
-            shell_id = event['param1']
-            if shell_id not in self.shells:
-                self.logger.debug('Tracking new shell {} for which we missed the shell creation event.'
-                                  ''.format(shell_id))
-                self.shells.append(shell_id)
-            if activity_id not in self.activity_shell_contexts:
-                self.logger.debug('Tracking shell {} against ActivityID: {}'.format(shell_id, activity_id))
-                self.activity_shell_contexts[activity_id] = shell_id
-        # A shell may have closed
-        elif 'Reporting operation complete for request: %1' in event['Description']:
-            request_id = event['param1']
-            # error_code = event['param2']
-            # error_message = event['param3']  # May be blank
-            # stack_trace = event['param4']  # May be blank
-            if request_id in self.shells:
-                # This request ID is being tracked as a shell context. As it is not closed, remove all tracking.
-                self.logger.debug('Shell {} closed, removing tracking data.'.format(request_id))
-                self.shells = [v for v in self.shells if v != request_id]
-                self.activity_shell_contexts = {k: v for k, v in self.activity_shell_contexts.items() if
-                                                v != request_id}
+        # Each event Id (and Version) always uses the same message template, so the template only needs to be matched
+        # against the Description the first time an Id is seen. After that the handler comes straight from the cache.
+        descriptor = header['EventDescriptor']
+        event_key = (descriptor['Id'], descriptor['Version'])
+        try:
+            handler = self.shell_context_handlers[event_key]
+        except KeyError:
+            handler = self._match_shell_context_handler(event['Description'])
+            self.shell_context_handlers[event_key] = handler
+        if handler is not None:
+            handler(event, activity_id)
+
+    # Find the handler for a shell context event based on its message template. Returns None for events we do not need
+    # to handle.
+    def _match_shell_context_handler(self, description):
+        if 'Request %1. Creating a server remote session.' in description:
+            return self._shell_created
+        elif 'Shell Context %1. Request Id %2' in description:
+            return self._shell_context
+        elif 'Reporting operation complete for request: %1' in description:
+            return self._operation_complete
+        return None
+
+    # A new shell context has been created
+    def _shell_created(self, event, activity_id):
+        # Context for a newly created shell
+        shell_id = event['param1']
+        username = event['param2']  # TODO add user context to the tracked shell
+        self.logger.debug('Tracking new shell {} against ActivityID: {}'.format(shell_id, activity_id))
+        self.shells.add(shell_id)
+        self._track_activity(activity_id, shell_id)
+
+    # Identify shell context for an existing shell
+    def _shell_context(self, event, activity_id):
+        shell_id = event['param1']
+        if shell_id not in self.shells:
+            self.logger.debug('Tracking new shell {} for which we missed the shell creation event.'
+                              ''.format(shell_id))
+            self.shells.add(shell_id)
+        if activity_id not in self.activity_shell_contexts:
+            self.logger.debug('Tracking shell {} against ActivityID: {}'.format(shell_id, activity_id))
+            self._track_activity(activity_id, shell_id)
+
+    # A shell may have closed
+    def _operation_complete(self, event, activity_id):
+        request_id = event['param1']
+        # error_code = event['param2']
+        # error_message = event['param3']  # May be blank
+        # stack_trace = event['param4']  # May be blank
+        if request_id in self.shells:
+            # This request ID is being tracked as a shell context. As it is not closed, remove all tracking.
+            self.logger.debug('Shell {} closed, removing tracking data.'.format(request_id))
+            self.shells.discard(request_id)
+            for closed_activity_id in self.shell_activities.pop(request_id, ()):
+                self.activity_shell_contexts.pop(closed_activity_id, None)
+
+    # Associate an ActivityID with a shell_id, keeping the shell_activities reverse mapping in step
+    def _track_activity(self, activity_id, shell_id):
+        previous_shell_id = self.activity_shell_contexts.get(activity_id)
+        if previous_shell_id is not None and previous_shell_id != shell_id:
+            self.shell_activities[previous_shell_id].discard(activity_id)
+        self.activity_shell_contexts[activity_id] = shell_id
+        self.shell_activities.setdefault(shell_id, set()).add(activity_id)
 
 
 class ETWRemotePSBase(etw.ETW):
@@ -103,13 +188,15 @@ class ETWRemotePSBase(etw.ETW):
         self.logger = logging.getLogger(ETWWinRM.LOGGER_NAME)
         self.real_event_callback = event_callback
         self.session_name = session_name
+        # Checked for every event, so held as a frozenset for constant time lookups
         if include_pids is None:
-            self.include_pids = []
+            self.include_pids = frozenset()
         else:
-            self.include_pids = include_pids
+            self.include_pids = frozenset(include_pids)
         super().__init__(session_name=session_name, providers=providers, event_callback=self.event_callback_hook)
 
-    # Adds logging to the callback
+    # Adds logging to the callback. Note that despite the name, events from processes in include_pids are filtered out:
+    # the entry points pass the svchost.exe PIDs here so that events logged by the service hosts are skipped.
     def event_callback_hook(self, event_tuple):
         event_id, event = event_tuple
         include = False
@@ -144,5 +231,6 @@ class ETWPowerShell(ETWRemotePSBase):
     def __init__(self, event_callback, session_name='PSRP_monitor', include_pids=None):
         providers = [etw.ProviderInfo('Microsoft-Windows-PowerShell',
                                       etw.GUID('{A0C1853B-5C40-4B15-8766-3CF1C58F985A}'), level=5,
-                                      any_keywords=0x4000000000000008 | 0x4000000000000100)]
+                                      any_keywords=(PowerShellETWParser.KEYWORD_PSRP_FRAGMENT
+                                                    | PowerShellETWParser.KEYWORD_SHELL_CONTEXT))]
         super().__init__(event_callback, providers, session_name=session_name, include_pids=include_pids)
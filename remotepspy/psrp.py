@@ -1,8 +1,10 @@
 import logging
 import struct
+import codecs
 from uuid import UUID
 import html
 import re
+from functools import lru_cache
 
 
 class PSRPParser:
@@ -42,22 +44,31 @@ class PSRPParser:
         0x0002100C: 'RESET_RUNSPACE_STATE'
     }
 
+    # Matches characters encoded according to [MS-PSRP] 2.2.5.3, e.g. _x000A_
+    ENCODED_CHAR_RE = re.compile(r'_x([0-9A-Fa-f]{4})_')
+
     def __init__(self, callback):
         self.logger = logging.getLogger(PSRPParser.LOGGER_NAME)
         self.callback = callback
 
+    # The message is a complete PSRP message as 'bytes', as produced by PSRPDefragmenter.
     def new_psrp_message(self, shell_id, object_id, message, command_id):
         # Decode message
-        destination, message_type = struct.unpack('<II', message[:8])
-        rpid = UUID(bytes_le=bytes(message[8:24]))
+        destination, message_type = struct.unpack_from('<II', message)
+        rpid = UUID(bytes_le=message[8:24])
         # While the spec defines pipeline_id as "PID", we call it pipeline_id to avoid confusion with Process ID
-        pipeline_id = UUID(bytes_le=bytes(message[24:40]))
-        data = message[40:].decode('utf-8-sig')
+        pipeline_id = UUID(bytes_le=message[24:40])
+        # Data is UTF-8 encoded XML. It is passed on as bytes, as the XML parser works on the encoded form anyway, with
+        # any BOM stripped.
+        data = message[40:]
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
         # Log full message to debug log
-        self.logger.debug('New PSRP message for ShellID: {}, ObjectID: {}, Destination: {}, MessageType: {}, '
-                          'RPID: {}, PipelineID: {}, Data: {}'
-                          ''.format(shell_id, object_id, destination, PSRPParser._msg_type_name(message_type), rpid,
-                                    pipeline_id, data))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('New PSRP message for ShellID: {}, ObjectID: {}, Destination: {}, MessageType: {}, '
+                              'RPID: {}, PipelineID: {}, Data: {}'
+                              ''.format(shell_id, object_id, destination, PSRPParser._msg_type_name(message_type),
+                                        rpid, pipeline_id, data.decode('utf-8', 'replace')))
         self.callback(destination, message_type, rpid, pipeline_id, data)
 
     # If 'unknown' is not specified, throws KeyError on unknown type; otherwise, returns the value of 'unknown' (which
@@ -72,25 +83,34 @@ class PSRPParser:
             else:
                 return unknown
 
+    # Results are cached, as the same strings (command names, property names, prompts) recur across many messages
     @staticmethod
+    @lru_cache(maxsize=1024)
     def deserialize_string(serialized, htmldecode=False):
         """Utility method to decode Clixml Strings that contain characters encoded according to [MS-PSRP] 2.2.5.3.
         These are characters that look like _xHHHH_ where H is a hex digit of a UTF-16 character code
         (e.g. _x000A_ for a newline).
         If htmldecode is True, also decode HTML characters (e.g. '&gt;' becomes '>').
         """
-        def re_replacer(match):
-            match = match.group(1)
-            return bytes.fromhex(match).decode('utf-16be')
-        deserialized = re.sub(r'_x([0-9A-Fa-f]{4})_', re_replacer, serialized)
+        # Most strings contain no encoded characters at all, so avoid running the regex in that case
+        if '_x' in serialized:
+            deserialized = PSRPParser.ENCODED_CHAR_RE.sub(PSRPParser._encoded_char_replacer, serialized)
+        else:
+            deserialized = serialized
         if htmldecode:
             deserialized = html.unescape(deserialized)
         return deserialized
 
+    @staticmethod
+    def _encoded_char_replacer(match):
+        return bytes.fromhex(match.group(1)).decode('utf-16be')
+
 
 class PSRPDefragmenter:
     LOGGER_NAME = 'RemotePSpy.psrpfrag'
-    FRAG_HEADER_LEN = 21
+    # ObjectId, FragmentId, E/S flags, BlobLength
+    FRAG_HEADER = struct.Struct('>qqbI')
+    FRAG_HEADER_LEN = FRAG_HEADER.size
     END_MASK = 2
     START_MASK = 1
 
@@ -99,7 +119,9 @@ class PSRPDefragmenter:
         self.completed_psrp_callback = completed_psrp_callback
         # Stores object buffers per Shell, by Shell ID.
         # The object buffers will use a fragment's ObjectID to track an individual PSRP message's fragments.
-        # E.g.: {shell_id: {obj_id: {'last_fragment_id': id, 'buffer': appended_fragment_bytes,
+        # Fragment payloads are collected in a list and only joined once the end fragment arrives, so that large
+        # multi-fragment messages are not repeatedly reallocated and copied as they grow.
+        # E.g.: {shell_id: {obj_id: {'last_fragment_id': id, 'chunks': [fragment_bytes, ...],
         #                            'command_id': optional_command_id}}}
         self.shell_bufs = {}
         # As above, but for pending shells, using message_id instead of shell_id
@@ -112,7 +134,8 @@ class PSRPDefragmenter:
         self._append_frag_data(object_id, fragment_id, s_flag, e_flag, frag_data, shell_id, self.has_shell,
                                self.new_shell, self.shell_bufs, self.completed_psrp_callback)
 
-    # Process new PSRP fragment data (a 'bytes') for a known shell. There may be more than one fragment.
+    # Process new PSRP fragment data (a bytes-like object) for a known shell. There may be more than one fragment.
+    # The data is referenced rather than copied until its message is complete, so it must not be modified afterwards.
     # (pending shells should use new_fragment_data_pending_shell() and use message_id instead of shell_id)
     def new_fragment_data(self, shell_id, fragment_data, command_id=None):
         self._new_fragment_data(shell_id, self.has_shell, self.new_shell, self.shell_bufs, self.completed_psrp_callback,
@@ -127,52 +150,74 @@ class PSRPDefragmenter:
 
     def _new_fragment_data(self, identifier, has_identifier_func, new_ident_func, bufs, message_complete_callback,
                            fragment_data, command_id=None):
+        # Fragment payloads are sliced from a memoryview so that they are not copied until the message is complete
+        fragment_data = memoryview(fragment_data)
+        # Values which are the same for every fragment are looked up once, outside the loop
+        unpack_header = PSRPDefragmenter.FRAG_HEADER.unpack_from
+        header_len = PSRPDefragmenter.FRAG_HEADER_LEN
+        total_len = len(fragment_data)
+        start_mask = PSRPDefragmenter.START_MASK
+        end_mask = PSRPDefragmenter.END_MASK
+        append_frag_data = self._append_frag_data
         # Loop through all the fragments in the data provided
         frag_offset = 0
-        while frag_offset < len(fragment_data):
+        while frag_offset < total_len:
             # Decode fragment header
-            frag_header_end = frag_offset + PSRPDefragmenter.FRAG_HEADER_LEN
-            object_id, fragment_id, e_s, frag_len = struct.unpack('>qqbI', fragment_data[frag_offset:frag_header_end])
+            data_start = frag_offset + header_len
+            object_id, fragment_id, e_s, frag_len = unpack_header(fragment_data, frag_offset)
             # Grab the fragment payload (partial PSRP data)
-            data_start = frag_offset + PSRPDefragmenter.FRAG_HEADER_LEN
-            data_end = frag_offset + PSRPDefragmenter.FRAG_HEADER_LEN + frag_len
+            data_end = data_start + frag_len
             frag_data = fragment_data[data_start:data_end]
-            s_flag = PSRPDefragmenter._start_bit_set(e_s)
-            e_flag = PSRPDefragmenter._end_bit_set(e_s)
+            # Flags are left as ints, which are only ever tested for truthiness
+            s_flag = e_s & start_mask
+            e_flag = e_s & end_mask
             # Store the fragment to the appropriate buffer
-            self._append_frag_data(object_id, fragment_id, s_flag, e_flag, frag_data, identifier, has_identifier_func,
-                                   new_ident_func, bufs, message_complete_callback, command_id=command_id)
+            append_frag_data(object_id, fragment_id, s_flag, e_flag, frag_data, identifier, has_identifier_func,
+                             new_ident_func, bufs, message_complete_callback, command_id=command_id)
             # Advance to next fragment
-            frag_offset += PSRPDefragmenter.FRAG_HEADER_LEN + frag_len
+            frag_offset = data_end
 
     def _append_frag_data(self, object_id, fragment_id, s_flag, e_flag, frag_data, identifier, has_identifier_func,
                           new_ident_func, bufs, message_complete_callback, command_id=None):
         # Check we are tracking the shell_id
         if not has_identifier_func(identifier):
             self.logger.info('Adding tracking for a Shell {} we were not tracking before, but have received '
-                             'fragment data for.')
+                             'fragment data for.'.format(identifier))
             new_ident_func(identifier)
+        object_bufs = bufs[identifier]
+        # Most messages fit in a single fragment (both S and E set), in which case there is nothing to reassemble, so
+        # skip buffering and pass the message straight on.
+        if s_flag and e_flag and fragment_id == 0 and object_id not in object_bufs:
+            self.logger.info('Single fragment message for ShellID: {}, ObjectID: {}'.format(identifier, object_id))
+            message_complete_callback(identifier, object_id, bytes(frag_data), command_id)
+            return
         # Check we have a buffer for the object_id
-        if object_id not in bufs[identifier]:
-            bufs[identifier][object_id] = {'last_fragment_id': -1, 'buffer': bytearray()}
-        bufs[identifier][object_id]['command_id'] = command_id
+        object_buf = object_bufs.get(object_id)
+        if object_buf is None:
+            object_buf = {'last_fragment_id': -1, 'chunks': []}
+            object_bufs[object_id] = object_buf
+        object_buf['command_id'] = command_id
         # Check the fragment is the one we were expecting next
-        expected_frag_id = bufs[identifier][object_id]['last_fragment_id'] + 1
+        expected_frag_id = object_buf['last_fragment_id'] + 1
         if expected_frag_id != fragment_id:
             self.logger.error('Unexpected or out-of-order fragment for Shell ID: {}, Object ID: {}. Expected '
                               'Fragment ID {}, got {}.'.format(identifier, object_id, expected_frag_id, fragment_id))
             return
-        self.logger.debug('New fragment for ShellID: {}, ObjectID {}: {}'.format(identifier, object_id, frag_data))
-        # Append to appropriate buffer
-        bufs[identifier][object_id]['buffer'].extend(frag_data)
+        object_buf['last_fragment_id'] = fragment_id
+        # Formatting the fragment data is expensive, so only do it if it will actually be logged
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('New fragment for ShellID: {}, ObjectID {}: {}'.format(identifier, object_id,
+                                                                                    bytes(frag_data)))
+        # Append to appropriate buffer. This may be a memoryview, which b''.join() accepts without an extra copy.
+        object_buf['chunks'].append(frag_data)
         # Check E (end fragment) bit in e_s to see if this is the last fragment. If so, pass on completed PSRP
         # message to the callback.
         if e_flag:
             self.logger.info('End fragment found for ShellID: {}, ObjectID: {}'.format(identifier, object_id))
-            message_complete_callback(identifier, object_id, bufs[identifier][object_id]['buffer'],
-                                      bufs[identifier][object_id]['command_id'])
+            message = b''.join(object_buf['chunks'])
+            message_complete_callback(identifier, object_id, message, object_buf['command_id'])
             # Remove ref to completed buffer
-            bufs[identifier].pop(object_id)
+            object_bufs.pop(object_id)
 
     # Instead of using the standard message callback, pending shells use this internal one which just stash the
     # completed message until a shell_id is received for the shell, at which point the messages are propogated on via
@@ -237,11 +282,3 @@ class PSRPDefragmenter:
         if shell_id in self.shell_bufs:
             self.logger.debug('Discarding buffers for deleted Shell ID {}'.format(shell_id))
             self.shell_bufs.pop(shell_id)
-
-    @staticmethod
-    def _end_bit_set(e_s):
-        return e_s & PSRPDefragmenter.END_MASK > 0
-
-    @staticmethod
-    def _start_bit_set(e_s):
-        return e_s & PSRPDefragmenter.START_MASK > 0
@@ -1,6 +1,8 @@
 import logging
+import sys
 import xml.etree.ElementTree as ET
-import base64
+import binascii
+from functools import lru_cache
 
 from remotepspy.psrp import PSRPParser
 
@@ -12,29 +14,57 @@ class SimpleCommandTracer:
 
     LOGGER_NAME = 'RemotePSpy.simple_cmd'
 
+    # Paths used to find elements of interest in Clixml messages. ElementTree compiles each path the first time it is
+    # used and caches it, so these are not re-parsed per message.
+    PATH_CMDS = "MS/Obj[@N='PowerShell']/MS/Obj[@N='Cmds']/LST"
+    PATH_METHOD_ID = "MS/Obj[@N='mi']/ToString"
+    PATH_METHOD_PARAMS = "MS/Obj[@N='mp']/LST"
+    # Attributes which must appear in the raw message data for the above paths to match. Checked before parsing so that
+    # messages which cannot contain anything of interest are dropped without being parsed.
+    CMDS_MARKER = b'N="Cmds"'
+    METHOD_ID_MARKER = b'N="mi"'
+
     def __init__(self):
         self.logger = logging.getLogger(SimpleCommandTracer.LOGGER_NAME)
         self.prompt_incoming = False
+        # Trace output is written straight to stdout, rather than through print()
+        self.out = sys.stdout
+        # Message handlers keyed by the raw MessageType, so each message needs only a single lookup. Message types not
+        # in here are not of interest for a simple command trace.
+        handlers_by_name = {
+            'CREATE_PIPELINE': self.msg_create_pipeline,
+            'PIPELINE_HOST_CALL': self.msg_pipeline_host_call,
+            'PIPELINE_OUTPUT': self.msg_pipeline_output
+        }
+        self.message_handlers = {msg_type: handlers_by_name[name] for msg_type, name in PSRPParser.MSG_TYPES.items()
+                                 if name in handlers_by_name}
+        # Handlers for supported PIPELINE_HOST_CALL methods, keyed by method name
+        self.host_call_handlers = {
+            'WriteLine2': self._pipeline_method_WriteLine2,
+            'Write2': self._pipeline_method_Write2,
+            'WriteLine3': self._pipeline_method_WriteLine3,
+            'SetShouldExit': self._pipeline_method_SetShouldExit
+        }
 
+    # Accepts a PSRP message from PSRPParser. The message data is the UTF-8 encoded Clixml, as bytes.
     def message(self, destination, message_type, rpid, pipeline_id, data):
-        if message_type not in PSRPParser.MSG_TYPES:
-            self.logger.error('Unrecognised MessageType: {}'.format(message_type))
+        handler = self.message_handlers.get(message_type)
+        if handler is None:
+            if message_type not in PSRPParser.MSG_TYPES:
+                self.logger.error('Unrecognised MessageType: {}'.format(message_type))
             return
-        if PSRPParser.MSG_TYPES[message_type] == 'CREATE_PIPELINE':
-            self.msg_create_pipeline(data, rpid, pipeline_id, destination)
-        elif PSRPParser.MSG_TYPES[message_type] == 'PIPELINE_HOST_CALL':
-            self.msg_pipeline_host_call(data, rpid, pipeline_id, destination)
-        elif PSRPParser.MSG_TYPES[message_type] == 'PIPELINE_OUTPUT':
-            self.msg_pipeline_output(data, rpid, pipeline_id, destination)
+        handler(data, rpid, pipeline_id, destination)
 
     def msg_create_pipeline(self, data, rpid, pipeline_id, destination):
-        if data == '':
+        if not data:
             self.logger.warning('Empty message data in CREATE_PIPELINE message. Runspace: {}, Pipeline: {}, '
                                 'Destination: {}'.format(rpid, pipeline_id, destination))
             return
+        if SimpleCommandTracer.CMDS_MARKER not in data:
+            return  # No Cmds list
         doc = ET.fromstring(data)
         # Find Cmds list
-        lst = doc.find("MS/Obj[@N='PowerShell']/MS/Obj[@N='Cmds']/LST")
+        lst = doc.find(SimpleCommandTracer.PATH_CMDS)
         if lst is None:
             return
         cmds = list(lst)
@@ -45,8 +75,19 @@ class SimpleCommandTracer:
             ms = cmd_obj.find('MS')
             if ms is None:
                 continue
-            # Find and decode the command
-            cmd = ms.find("S[@N='Cmd']")
+            # Find the command and its args list in a single pass over the members of the <MS>. Either may be missing.
+            cmd = None
+            args = None
+            args_lst = None
+            for member in ms:
+                tag = member.tag
+                if tag == 'S':
+                    if cmd is None and member.get('N') == 'Cmd':
+                        cmd = member
+                elif tag == 'Obj':
+                    if args is None and member.get('N') == 'Args':
+                        args = member
+                        args_lst = args.find('LST')
             if cmd is None:
                 continue
             cmd = cmd.text
@@ -59,10 +100,8 @@ class SimpleCommandTracer:
                 return
             cmd = PSRPParser.deserialize_string(cmd)
             final_cmd_str = [cmd]  # Will be joined together with space separator
-            # Find any args
+            # Add any args
             # NOTE: this does not currently support all complex type arguments, only strings and arrays of strings
-            args = ms.find("Obj[@N='Args']")
-            args_lst = args.find('LST')
             if args_lst is not None:
                 self.get_cmd_args(args_lst, final_cmd_str)
             # Join an individual command and its arguments together
@@ -70,39 +109,48 @@ class SimpleCommandTracer:
         # Join commands together
         full_cmd_str = ' | '.join(parsed_cmds)
         # Output the final result
-        print(full_cmd_str)
-        self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, Command: {}'.format(rpid, pipeline_id,
-                                                                                          destination, full_cmd_str))
+        self.out.write(full_cmd_str + '\n')
+        # Log messages are only formatted if INFO logging is enabled, as this is done for every message
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, Command: {}'.format(rpid, pipeline_id,
+                                                                                              destination,
+                                                                                              full_cmd_str))
 
     def msg_pipeline_host_call(self, data, rpid, pipeline_id, destination):
-        if data == '':
+        if not data:
             self.logger.warning('Empty message data in PIPELINE_HOST_CALL message. Runspace: {}, Pipeline: {}, '
                                 'Destination: {}'.format(rpid, pipeline_id, destination))
             return
-        doc = ET.fromstring(data)
-        method = doc.find("MS/Obj[@N='mi']/ToString")
+        doc, method = SimpleCommandTracer._parse_host_call(data)
         if method is None:
             self.logger.error('Could not find method identifier in PIPELINE_HOST_CALL. Runspace: {}, Pipeline: {}, '
-                              'Destination: {}, Data: {}'.format(rpid, pipeline_id, destination, data))
+                              'Destination: {}, Data: {}'.format(rpid, pipeline_id, destination,
+                                                                 data.decode('utf-8', 'replace')))
             return
         method = method.text
         # TODO we can support more functions later, the full list is at [MS-PSRP] 2.2.3.17
         # (https://msdn.microsoft.com/en-us/library/dd306624.aspx)
-        if method == 'WriteLine2':
-            self._pipeline_method_WriteLine2(doc, rpid, pipeline_id, destination)
-        elif method == 'Write2':
-            self._pipeline_method_Write2(doc, rpid, pipeline_id, destination)
-        elif method == 'WriteLine3':
-            self._pipeline_method_WriteLine3(doc, rpid, pipeline_id, destination)
-        elif method == 'SetShouldExit':
-            pass  # Nothing really needed to be done
+        handler = self.host_call_handlers.get(method)
+        if handler is not None:
+            handler(doc, rpid, pipeline_id, destination)
         else:
-            print('[Unsupported PIPELINE_HOST_CALL method: {}]'.format(method))
+            self.out.write('[Unsupported PIPELINE_HOST_CALL method: {}]\n'.format(method))
             self.logger.warning('Unsupported PIPELINE_HOST_CALL method: {}. Runspace: {}, Pipeline: {}, Destination:{}'
                                 ''.format(method, rpid, pipeline_id, destination))
 
+    # Parse PIPELINE_HOST_CALL data, returning the document and its method identifier element (or None if there is no
+    # method identifier). Host calls such as SetShouldExit and prompt writes are often repeated verbatim, so recent
+    # results are cached. The returned document is shared between calls, so must not be modified.
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _parse_host_call(data):
+        if SimpleCommandTracer.METHOD_ID_MARKER not in data:
+            return None, None
+        doc = ET.fromstring(data)
+        return doc, doc.find(SimpleCommandTracer.PATH_METHOD_ID)
+
     def msg_pipeline_output(self, data, rpid, pipeline_id, destination):
-        if data == '':
+        if not data:
             self.logger.info('Empty message data in PIPELINE_OUTPUT message. Runspace: {}, Pipeline: {}, '
                              'Destination: {}'.format(rpid, pipeline_id, destination))
             return
@@ -110,16 +158,19 @@ class SimpleCommandTracer:
         # If we're expecting an incoming prompt value to display, do so now
         if self.prompt_incoming:
             if doc.tag != 'S':
+                data = data.decode('utf-8')
                 self.logger.warning('Unsupported type received for prompt: {}'.format(data))
-                print('[UNSUPPORTED TYPE RECEIVED FOR PROMPT]:\n{}'.format(data))
+                self.out.write('[UNSUPPORTED TYPE RECEIVED FOR PROMPT]:\n{}\n'.format(data))
                 return
             prompt = doc.text
             if prompt is None:
                 return
             prompt = PSRPParser.deserialize_string(prompt, htmldecode=True)
-            print(prompt, end='', flush=True)
-            self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, Prompt: {}'.format(rpid, pipeline_id,
-                                                                                             destination, prompt))
+            self.out.write(prompt)
+            self.out.flush()
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, Prompt: {}'.format(rpid, pipeline_id,
+                                                                                                 destination, prompt))
             self.prompt_incoming = False
         else:
             # NOTE: most complex types are not yet supported and will be output as raw CLIXML.
@@ -134,63 +185,30 @@ class SimpleCommandTracer:
                     elif tns[0].text == 'Selected.System.Management.ManagementObject':
                         self.output_management_object(doc, rpid, pipeline_id, destination)
                     else:
+                        data = data.decode('utf-8')
                         self.logger.warning('Unsupported type in PIPELINE_OUTPUT: {}'.format(data))
-                        print('[UNSUPPORTED TYPE RECEIVED]:\n{}'.format(data))
+                        self.out.write('[UNSUPPORTED TYPE RECEIVED]:\n{}\n'.format(data))
             else:
                 # Output any basic types we support. Primitive types are defined in [MS-PSRP] 2.2.5.1.
                 output = SimpleCommandTracer.deseiralize_element(doc)
                 if output is not None:
-                    print(output)
-                    self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, <{}> output: {}'
-                                     ''.format(rpid, pipeline_id, destination, doc.tag, output))
+                    self.out.write(output + '\n')
+                    if self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, <{}> output: {}'
+                                         ''.format(rpid, pipeline_id, destination, doc.tag, output))
 
     # Note: Only basic types supported, and not yet fully.
     @staticmethod
     def deseiralize_element(elem):
-        output = None
-        if elem.tag == 'Nil':
-            output = None  # Just ignore
-        elif elem.tag == 'S' or elem.tag == 'SBK' or elem.tag == 'Version' or elem.tag == 'URI':
-            if elem.text is None:
-                output = ''
-            else:
-                output = PSRPParser.deserialize_string(elem.text)
-        elif elem.tag == 'XD':
-            if elem.text is None:
-                output = ''
-            else:
-                output = PSRPParser.deserialize_string(elem.text, htmldecode=True)
-        elif elem.tag == 'GUID':
-            # Wrap output in curly brackets
-            output = '{{{}}}'.format(elem.text)
-        elif elem.tag == 'SecureString':
-            output = '[SecureString]{}'.format(elem.text)
-        elif (elem.tag == 'D' or elem.tag == 'Dd' or elem.tag == 'Sg' or elem.tag == 'I64'
-              or elem.tag == 'U64' or elem.tag == 'I32' or elem.tag == 'U32' or elem.tag == 'I16'
-              or elem.tag == 'U16' or elem.tag == 'DT' or elem.tag == 'B'):
-            if elem.text is None:
-                output = ''
-            else:
-                output = elem.text
-        elif elem.tag == 'C':
-            output = '[char_code]{}'.format(elem.text)
-        elif elem.tag == 'BA':
-            if elem.text is None:
-                output = "b''"
-            else:
-                byte_array = base64.b64decode(elem.text)
-                output = '{}'.format(byte_array)
-        elif elem.tag == 'SB':
-            output = '[signed_byte]{}'.format(elem.text)
-        elif elem.tag == 'By':
-            output = '[unsigned_byte]{}'.format(elem.text)
-        else:
+        tag = elem.tag
+        deserializer = _ELEMENT_DESERIALIZERS.get(tag)
+        if deserializer is None:
             # Types not yet supported fall into here
-            output = '[unsupported-{}-type]{}'.format(elem.tag, ET.tostring(elem).decode('utf-8'))
-        return output
+            return '[unsupported-{}-type]{}'.format(tag, ET.tostring(elem, encoding='unicode'))
+        return deserializer(elem.text)
 
     def _pipeline_method_WriteLine2(self, doc, rpid, pipeline_id, destination):
-        output_lst = doc.find("MS/Obj[@N='mp']/LST")
+        output_lst = doc.find(SimpleCommandTracer.PATH_METHOD_PARAMS)
         if output_lst is None:
             self.logger.debug('Runspace: {}, Pipeline: {}, Destination: {}, WriteLine2() called with no arguments'
                               ''.format(rpid, pipeline_id, destination))
@@ -198,9 +216,13 @@ class SimpleCommandTracer:
         for elem in list(output_lst):
             output = SimpleCommandTracer.deseiralize_element(elem)
             if output is not None:
-                print(output)
-                self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, WriteLine2({})'
-                                 ''.format(rpid, pipeline_id, destination, output.encode('utf-8')))
+                self.out.write(output + '\n')
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, WriteLine2({})'
+                                     ''.format(rpid, pipeline_id, destination, output.encode('utf-8')))
+
+    def _pipeline_method_SetShouldExit(self, doc, rpid, pipeline_id, destination):
+        pass  # Nothing really needed to be done
 
     def _pipeline_method_Write2(self, doc, rpid, pipeline_id, destination):
         self._pipeline_write_with_colours(doc, rpid, pipeline_id, destination, False, 'Write2')
@@ -210,7 +232,7 @@ class SimpleCommandTracer:
 
     # Supports the workings of Write2 and WriteLine3, which operate the same except for whether a newline is output.
     def _pipeline_write_with_colours(self, doc, rpid, pipeline_id, destination, newline_flag, method_name):
-        method_args = doc.find("MS/Obj[@N='mp']/LST")
+        method_args = doc.find(SimpleCommandTracer.PATH_METHOD_PARAMS)
         if method_args is None:
             self.logger.debug('Runspace: {}, Pipeline: {}, Destination: {}, {}() called with no arguments'
                               ''.format(rpid, pipeline_id, destination, method_name))
@@ -226,11 +248,13 @@ class SimpleCommandTracer:
         output = SimpleCommandTracer.deseiralize_element(elem)
         if output is not None:
             if newline_flag:
-                print(output)
+                self.out.write(output + '\n')
             else:
-                print(output, end='', flush=True)
-            self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, {}({})'
-                             ''.format(rpid, pipeline_id, destination, method_name, output.encode('utf-8')))
+                self.out.write(output)
+                self.out.flush()
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, {}({})'
+                                 ''.format(rpid, pipeline_id, destination, method_name, output.encode('utf-8')))
 
     def get_cmd_args(self, args_lst, final_cmd_str):
         arg_objs = list(args_lst)
@@ -267,9 +291,11 @@ class SimpleCommandTracer:
                                 final_cmd_str.append('"' + final_values + '"')
                             final_cmd_str.append(final_values)
                 else:
+                    # Serialized once, as it is needed for both the warning and the printed output
+                    unsupported_xml = ET.tostring(elem, encoding='unicode')
                     self.logger.warning('Unsupported type in args list of a cmd in CREATE_PIPELINE message: {}'
-                                        ''.format(ET.tostring(elem).decode('utf-8')))
-                    print('[UNSUPPORTED ARG TYPE RECEIVED]: {}'.format(ET.tostring(elem).decode('utf-8')))
+                                        ''.format(unsupported_xml))
+                    self.out.write('[UNSUPPORTED ARG TYPE RECEIVED]: {}\n'.format(unsupported_xml))
 
     def output_management_object(self, serialized_element, rpid, pipeline_id, destination):
         # Output a set of Strings as property_name:value pairs
@@ -278,22 +304,23 @@ class SimpleCommandTracer:
             return
         for item in list(ms):
             if item.tag != 'S':
+                unsupported_xml = ET.tostring(item, encoding='unicode')
                 self.logger.warning('Unsupported type in PIPELINE_OUTPUT, in the <MS> element of a '
-                                    'Selected.System.Management.ManagementObject: {}'
-                                    ''.format(ET.tostring(item).decode('utf-8')))
-                print('[UNSUPPORTED TYPE RECEIVED]: {}'.format(ET.tostring(item).decode('utf-8')))
+                                    'Selected.System.Management.ManagementObject: {}'.format(unsupported_xml))
+                self.out.write('[UNSUPPORTED TYPE RECEIVED]: {}\n'.format(unsupported_xml))
                 continue
             value = item.text
             prop_name = SimpleCommandTracer.get_property_name(item)
             if prop_name is not None:
-                print('{}: {}'.format(prop_name, value))
-                self.logger.info("Runspace: {}, Pipeline: {}, Destination: {}, Output: '{}:{}'"
-                                 "".format(rpid, pipeline_id, destination, prop_name, value))
+                self.out.write('{}: {}\n'.format(prop_name, value))
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info("Runspace: {}, Pipeline: {}, Destination: {}, Output: '{}:{}'"
+                                     "".format(rpid, pipeline_id, destination, prop_name, value))
             else:
-                print(value)
-                self.logger.info(
-                    'Runspace: {}, Pipeline: {}, Destination: {}, Output: {}'.format(rpid, pipeline_id, destination,
-                                                                                     value))
+                self.out.write('{}\n'.format(value))
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info('Runspace: {}, Pipeline: {}, Destination: {}, Output: {}'
+                                     ''.format(rpid, pipeline_id, destination, value))
 
     # Return any property name from the 'N' attribute of an Element.
     @staticmethod
@@ -302,3 +329,75 @@ class SimpleCommandTracer:
             return None
         prop_name = elem.get('N')
         return PSRPParser.deserialize_string(prop_name)
+
+
+# Deserializers for the primitive types defined in [MS-PSRP] 2.2.5.1, used by SimpleCommandTracer.deseiralize_element().
+# Each takes the text of the element and returns its output string, or None if there is nothing to output.
+
+def _deserialize_nil(text):
+    return None  # Just ignore
+
+
+def _deserialize_string(text):
+    if text is None:
+        return ''
+    return PSRPParser.deserialize_string(text)
+
+
+def _deserialize_xml_document(text):
+    if text is None:
+        return ''
+    return PSRPParser.deserialize_string(text, htmldecode=True)
+
+
+def _deserialize_guid(text):
+    # Wrap output in curly brackets
+    return '{{{}}}'.format(text)
+
+
+def _deserialize_secure_string(text):
+    return '[SecureString]{}'.format(text)
+
+
+def _deserialize_plain(text):
+    if text is None:
+        return ''
+    return text
+
+
+def _deserialize_char(text):
+    return '[char_code]{}'.format(text)
+
+
+def _deserialize_byte_array(text):
+    if text is None:
+        return "b''"
+    # Equivalent to base64.b64decode(), without the Python level wrapper
+    return repr(binascii.a2b_base64(text))
+
+
+def _deserialize_signed_byte(text):
+    return '[signed_byte]{}'.format(text)
+
+
+def _deserialize_unsigned_byte(text):
+    return '[unsigned_byte]{}'.format(text)
+
+
+# Types which are output as a (possibly encoded) string
+_STRING_TAGS = frozenset({'S', 'SBK', 'Version', 'URI'})
+# Numeric, date/time and boolean types, which are output as their text unchanged
+_PLAIN_TAGS = frozenset({'D', 'Dd', 'Sg', 'I64', 'U64', 'I32', 'U32', 'I16', 'U16', 'DT', 'B'})
+
+_ELEMENT_DESERIALIZERS = {
+    'Nil': _deserialize_nil,
+    'XD': _deserialize_xml_document,
+    'GUID': _deserialize_guid,
+    'SecureString': _deserialize_secure_string,
+    'C': _deserialize_char,
+    'BA': _deserialize_byte_array,
+    'SB': _deserialize_signed_byte,
+    'By': _deserialize_unsigned_byte,
+}
+_ELEMENT_DESERIALIZERS.update(dict.fromkeys(_STRING_TAGS, _deserialize_string))
+_ELEMENT_DESERIALIZERS.update(dict.fromkeys(_PLAIN_TAGS, _deserialize_plain))
@@ -8,12 +8,24 @@ import base64
 import struct
 import xml.etree.ElementTree as ET
 import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 from remotepspy.psrp import PSRPDefragmenter
 from remotepspy.psrp import PSRPParser
 from remotepspy.simple_command_tracer import SimpleCommandTracer
 
 
+# Expands the namespace prefixes in a simple ElementTree path (such as 's:Body/rsp:Shell') to Clark notation, using the
+# given prefix to namespace mapping. Each step must have a prefix; any predicate on a step is left as it is.
+def _clark_path(path, namespaces):
+    steps = []
+    for step in path.split('/'):
+        prefix, tag = step.split(':')
+        steps.append('{{{}}}{}'.format(namespaces[prefix], tag))
+    return '/'.join(steps)
+
+
 class WSManPS:
     """Accepts complete WS-Man SOAP documents (such as those output by SoapDefragmenter), identifies those relating to
     PowerShell Remote Protocol (PSRP), and extracts raw PSRP data ready to be processed by the next layer.
@@ -34,13 +46,47 @@ class WSManPS:
         'x': 'http://schemas.xmlsoap.org/ws/2004/09/transfer'
     }
 
+    # Paths used to find elements in WS-Man SOAP. These are expanded to Clark notation ({namespace}tag) once here, so
+    # that namespace prefixes do not need to be resolved against NAMESPACES on every search.
+    PATH_HEADER = _clark_path('s:Header', NAMESPACES)
+    PATH_ACTION = _clark_path('a:Action', NAMESPACES)
+    PATH_RESOURCE_URI = _clark_path('w:ResourceURI', NAMESPACES)
+    PATH_TO = _clark_path('a:To', NAMESPACES)
+    PATH_MESSAGE_ID = _clark_path('a:MessageID', NAMESPACES)
+    PATH_RELATES_TO = _clark_path('a:RelatesTo', NAMESPACES)
+    PATH_RESOURCE_CREATED = _clark_path('s:Body/x:ResourceCreated', NAMESPACES)
+    PATH_ADDRESS = _clark_path('a:Address', NAMESPACES)
+    PATH_REFERENCE_PARAMETERS = _clark_path('a:ReferenceParameters', NAMESPACES)
+    PATH_SHELL_ID_SELECTOR = _clark_path("w:SelectorSet/w:Selector[@Name='ShellId']", NAMESPACES)
+    PATH_SHELL = _clark_path('s:Body/rsp:Shell', NAMESPACES)
+    PATH_CREATION_XML = _clark_path('ps:creationXml', NAMESPACES)
+    PATH_COMMAND_ID = _clark_path('s:Body/rsp:CommandResponse/rsp:CommandId', NAMESPACES)
+    PATH_RECEIVE_RESPONSE = _clark_path('s:Body/rsp:ReceiveResponse', NAMESPACES)
+    TAG_COMMAND_STATE = _clark_path('rsp:CommandState', NAMESPACES)
+    PATH_EXIT_CODE = _clark_path('rsp:ExitCode', NAMESPACES)
+    TAG_STREAM = _clark_path('rsp:Stream', NAMESPACES)
+    PATH_ARGUMENTS = _clark_path('s:Body/rsp:CommandLine/rsp:Arguments', NAMESPACES)
+    PATH_DESIRED_STREAMS = _clark_path('s:Body/rsp:Receive/rsp:DesiredStream', NAMESPACES)
+
     PS_RESOURCE_URI = 'http://schemas.microsoft.com/powershell/Microsoft.PowerShell'
 
+    # Every action in ps_actions contains one of these. SOAP containing none of them cannot have a PowerShell related
+    # action, so is ignored without being parsed.
+    PS_ACTION_MARKERS = ('/transfer/Create', '/transfer/Delete', '/windows/shell/', '/wsman/fault')
+
     ADDRESS_ANON = 'http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous'
 
     CMD_STATE_DONE = 'http://schemas.microsoft.com/wbem/wsman/1/windows/shell/CommandState/Done'
 
     WIMLIB_COMPRESSION_TYPE_XPRESS = 1
+    # Compression block sizes are sent as 16 bit values plus one, so a block never decompresses to more than this
+    XPRESS_MAX_BLOCK_SIZE = 65536
+    # Upper limit on tracked CommandIds. Commands whose finished state we never see (e.g. if an ETW event is missed)
+    # would otherwise be tracked forever, so the oldest are dropped once this many are tracked.
+    MAX_TRACKED_COMMANDS = 1024
+    # Header of each compression block in stream data: uncompressed size, compressed size (both out by one)
+    COMPRESSION_HEADER = struct.Struct('<HH')
+    COMPRESSION_HEADER_LEN = COMPRESSION_HEADER.size
 
     def __init__(self):
         self.logger = logging.getLogger(WSManPS.LOGGER_NAME)
@@ -58,10 +104,11 @@ class WSManPS:
         # DeleteResponse. Also links it to a ShellID.
         self.delete_msgs = {}
         # Tracks the MessageID of Create requests. These create Shells, and the response will contain the MessageID in
-        # the RelatesTo field, and a ShellId we will end up tracking via the PSRPDefragmenter.
-        self.create_msgs = []
-        # Tracks CommandId's known to relate to PowerShell
-        self.commands = {}
+        # the RelatesTo field, and a ShellId we will end up tracking via the PSRPDefragmenter. Held as a set, as it is
+        # only used for membership checks (the order Create requests were seen in is not needed).
+        self.create_msgs = set()
+        # Tracks CommandId's known to relate to PowerShell, oldest first, bounded by MAX_TRACKED_COMMANDS
+        self.commands = OrderedDict()
         # Actions known to relate to PowerShell, and pointers to handler functions
         self.ps_actions = {
             'http://schemas.xmlsoap.org/ws/2004/09/transfer/CreateResponse': self._action_create_response,
@@ -83,60 +130,76 @@ class WSManPS:
                 dll = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'libwim_bin', '32', 'libwim-15.dll')
             self.libwim = ctypes.CDLL(dll)
             # Set to 64k, but I'm not sure the xpress decompressor even uses this value!
-            max_block_size = 65536
+            max_block_size = WSManPS.XPRESS_MAX_BLOCK_SIZE
             self.xpress_decompressor = ctypes.c_void_p()
             # Normally we would need to free this after use, but as we expect it to live the lifetime of the program, we
             # don't bother.
             ret = self.libwim.wimlib_create_decompressor(WSManPS.WIMLIB_COMPRESSION_TYPE_XPRESS, max_block_size,
                                                          ctypes.byref(self.xpress_decompressor))
+            # Declare the signature of wimlib_decompress() once, so ctypes does not need to work out how to convert the
+            # arguments on every call:
+            # int wimlib_decompress(const void *compressed_data, size_t compressed_size, void *uncompressed_data,
+            #                       size_t uncompressed_size, struct wimlib_decompressor *decompressor)
+            self.wimlib_decompress = self.libwim.wimlib_decompress
+            self.wimlib_decompress.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t,
+                                               ctypes.c_void_p]
+            self.wimlib_decompress.restype = ctypes.c_int
             if ret != 0:
                 self.libwim = None
                 self.xpress_decompressor = None
+                self.wimlib_decompress = None
                 self.logger.error('Failed to create libwim decompressor. We will proceed and hope we are lucky enough '
                                   'to not encounter compression.')
         except (NameError, OSError):
             self.libwim = None
             self.xpress_decompressor = None
+            self.wimlib_decompress = None
             self.logger.error('Failed to load libwim-15.dll and instantiate an xpress decompressor. We will proceed '
                               'and hope we are lucky enough to not encounter compression.')
 
     def new_soap(self, activity_id, pid, tid, soap):
         try:
+            if not any(marker in soap for marker in WSManPS.PS_ACTION_MARKERS):
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('WS-Man did not look related to PowerShell so ignored as it does not contain a '
+                                      'PowerShell related action (activity_id: {}, pid: {}, tid: {}): {}'
+                                      ''.format(activity_id, pid, tid, soap))
+                return
             doc = ET.fromstring(soap)
-            header = doc.find('s:Header', WSManPS.NAMESPACES)
+            header = doc.find(WSManPS.PATH_HEADER)
             if header is None:
                 self.logger.error('Could not find header in WS-Man SOAP (activity_id: {}, pid: {}, tid: {}): {}'
                                   ''.format(activity_id, pid, tid, soap))
                 return
-            action = header.find('a:Action', WSManPS.NAMESPACES)
-            if action is not None:
-                action = action.text
+            # Collect the text of the header's children in a single pass, keyed by tag, rather than searching the header
+            # once for each value. The first occurrence of each tag is kept, as find() would. The header paths used
+            # below are single steps, so are the tags themselves.
+            header_values = {}
+            for child in header:
+                header_values.setdefault(child.tag, child.text)
+            action = header_values.get(WSManPS.PATH_ACTION)
             if action is None:
                 self.logger.error('Could not find action in WS-Man SOAP header (activity_id: {}, pid: {}, tid: {}): {}'
                                   ''.format(activity_id, pid, tid, soap))
                 return
-            if action not in self.ps_actions:
-                self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised action '
-                                  '(action: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                                  ''.format(action, activity_id, pid, tid, soap))
+            handler = self.ps_actions.get(action)
+            if handler is None:
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised '
+                                      'action (action: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                      ''.format(action, activity_id, pid, tid, soap))
                 return
-            resource_uri = header.find('w:ResourceURI', WSManPS.NAMESPACES)
-            if resource_uri is not None:
-                resource_uri = resource_uri.text
+            resource_uri = header_values.get(WSManPS.PATH_RESOURCE_URI)
             if resource_uri is not None and resource_uri != WSManPS.PS_RESOURCE_URI:
-                self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised '
-                                  'ResourceURI (ResourceURI: {}, action: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                                  ''.format(resource_uri, action, activity_id, pid, tid, soap))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised '
+                                      'ResourceURI (ResourceURI: {}, action: {}, activity_id: {}, pid: {}, tid: {}): '
+                                      '{}'.format(resource_uri, action, activity_id, pid, tid, soap))
                 return
-            to = header.find('a:To', WSManPS.NAMESPACES)
-            if to is not None:
-                to = to.text
-            message_id = header.find('a:MessageID', WSManPS.NAMESPACES)
-            if message_id is not None:
-                message_id = message_id.text
+            to = header_values.get(WSManPS.PATH_TO)
+            message_id = header_values.get(WSManPS.PATH_MESSAGE_ID)
             # Call appropriate handler
-            self.ps_actions[action](activity_id, pid, tid, doc, header, action, to, message_id,
-                                    resource_uri=resource_uri)
+            handler(activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=resource_uri)
         except Exception:
             tb = traceback.format_exc()
             self.logger.error('Error parsing SOAP XML (activity_id: {}, pid: {}, tid: {}): {} | Exception info: {}'
@@ -144,16 +207,14 @@ class WSManPS:
 
     def _action_create_response(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
         # See if there is a match in create_msgs
-        relates_to = header.find('a:RelatesTo', WSManPS.NAMESPACES)
-        if relates_to is not None:
-            relates_to = relates_to.text
+        relates_to = WSManPS._find_text(header, WSManPS.PATH_RELATES_TO)
         pending_match = False
         if relates_to is not None:
             if relates_to in self.create_msgs:
                 pending_match = True
                 self.create_msgs.remove(relates_to)  # Stop tracking
         # Extract some other important values
-        resource_created = doc.find('s:Body/x:ResourceCreated', WSManPS.NAMESPACES)
+        resource_created = doc.find(WSManPS.PATH_RESOURCE_CREATED)
         if resource_created is None:
             self.logger.error('Could not find s:Body/x:ResourceCreated in CreateResponse (action: {}, activity_id: {}, '
                               'pid: {}, tid: {}): {}'.format(action, activity_id, pid, tid,
@@ -161,26 +222,23 @@ class WSManPS:
             return
 
         # TODO not using address yet - maybe use in combination with <a:To>?
-        address = resource_created.find('a:Address', WSManPS.NAMESPACES)
-        if address is not None:
-            address = address.text
+        address = WSManPS._find_text(resource_created, WSManPS.PATH_ADDRESS)
 
-        res_params = resource_created.find('a:ReferenceParameters', WSManPS.NAMESPACES)
+        res_params = resource_created.find(WSManPS.PATH_REFERENCE_PARAMETERS)
         if res_params is None:
             self.logger.error('Could not find s:Body/x:ResourceCreated/a:ReferenceParameters in CreateResponse '
                               '(action: {}, activity_id: {}, pid: {}, tid: {}): {}'
                               ''.format(action, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
             return
-        body_resource_uri = res_params.find('w:ResourceURI', WSManPS.NAMESPACES)
-        if body_resource_uri is not None:
-            body_resource_uri = body_resource_uri.text
+        body_resource_uri = WSManPS._find_text(res_params, WSManPS.PATH_RESOURCE_URI)
         # Check whether to continue processing based on body_resource_uri and pending_match
         if not pending_match and body_resource_uri != WSManPS.PS_RESOURCE_URI:
-            self.logger.debug('WS-Man CreateResponse did not look related to PowerShell so ignored due to unrecognised '
-                              'ResourceURI in the Body and no previous matching Microsoft.PowerShell request '
-                              '(Body-ResourceId: {}, action: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(body_resource_uri, action, activity_id, pid, tid,
-                                        ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man CreateResponse did not look related to PowerShell so ignored due to '
+                                  'unrecognised ResourceURI in the Body and no previous matching Microsoft.PowerShell '
+                                  'request (Body-ResourceId: {}, action: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(body_resource_uri, action, activity_id, pid, tid,
+                                            ET.tostring(doc, encoding='unicode')))
             return
         elif pending_match and body_resource_uri != WSManPS.PS_RESOURCE_URI:
             self.logger.warning('The ResourceURI in the body of the CreateResponse did not look like PowerShell, but '
@@ -194,13 +252,7 @@ class WSManPS:
                                 'matching request. (RelatesTo: {}, Body-ResourceId: {}, ResourceURI: {}, action: {}, '
                                 'activity_id: {}, pid: {}, tid: {})'.format(relates_to, body_resource_uri, resource_uri,
                                                                             action, activity_id, pid, tid))
-        selectors = res_params.findall('w:SelectorSet/w:Selector', WSManPS.NAMESPACES)
-        shell_id = None
-        for selector in selectors:
-            name = selector.get('Name')
-            if name == 'ShellId':
-                shell_id = selector.text
-                break
+        shell_id = WSManPS._get_shell_id(res_params)
         if shell_id is None:
             self.logger.warning('No ShellId found in CreateResponse (ResourceURI: {}, action: {}, activity_id: {}, '
                                 'pid: {}, tid: {}): {}'.format(resource_uri, action, activity_id, pid, tid,
@@ -212,13 +264,12 @@ class WSManPS:
 
     def _action_delete_response(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
         # Look for a a matching Delete request in self.delete_msgs to obtain the ShellID context
-        relates_to = header.find('a:RelatesTo', WSManPS.NAMESPACES)
-        if relates_to is not None:
-            relates_to = relates_to.text
+        relates_to = WSManPS._find_text(header, WSManPS.PATH_RELATES_TO)
         if relates_to is None or relates_to not in self.delete_msgs:
-            self.logger.debug('WS-Man DeleteResponse did not look related to PowerShell so ignored due to '
-                              'unrecognised RelatedTo (action: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(action, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man DeleteResponse did not look related to PowerShell so ignored due to '
+                                  'unrecognised RelatedTo (action: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(action, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
             return
         shell_id = self.delete_msgs.pop(relates_to)
         # Remove shell from tracking in the PSRPDefragmenter
@@ -229,11 +280,12 @@ class WSManPS:
 
     def _action_create(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
         if resource_uri != WSManPS.PS_RESOURCE_URI:
-            self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised combination of '
-                              'action and ResourceURI (action: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(action, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man did not look related to PowerShell so ignored due to unrecognised '
+                                  'combination of action and ResourceURI (action: {}, activity_id: {}, pid: {}, tid: '
+                                  '{}): {}'.format(action, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
             return
-        shell = doc.find('s:Body/rsp:Shell', WSManPS.NAMESPACES)
+        shell = doc.find(WSManPS.PATH_SHELL)
         if shell is None:
             self.logger.warning('Could not find Shell element in Create Microsoft.PowerShell request.')
             return
@@ -248,12 +300,10 @@ class WSManPS:
         # if output_streams is not None:
         #     output_streams = output_streams.text
 
-        creation_xml = shell.find('ps:creationXml', WSManPS.NAMESPACES)
-        if creation_xml is not None:
-            creation_xml = creation_xml.text
+        creation_xml = WSManPS._find_text(shell, WSManPS.PATH_CREATION_XML)
         # Base64 decode the contents of creation_xml and pass up to next PSRP layer
         try:
-            creation_xml = base64.b64decode(creation_xml.encode('utf-8'))
+            creation_xml = WSManPS._b64_decode(creation_xml)
             # Pass on to defragmenter
             self.logger.info('New Shell create pending. Tracking pending Shell with MessageID: {}'.format(message_id))
             self.psrp_defrag.new_pending_shell(message_id)
@@ -265,9 +315,11 @@ class WSManPS:
 
     def _action_delete(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
         if not self._known_shell_id_or_resource_uri(header, resource_uri, action):
-            self.logger.debug('WS-Man Delete was not associated with a known PowerShell Shell or ResourceURI, so it '
-                              'will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(resource_uri, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man Delete was not associated with a known PowerShell Shell or ResourceURI, so '
+                                  'it will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(resource_uri, activity_id, pid, tid,
+                                            ET.tostring(doc, encoding='unicode')))
             return
         # Track by MessageID to match corresponding DeleteResponse and keep track of what Shell we are in
         self._track_delete(message_id, header)
@@ -276,19 +328,16 @@ class WSManPS:
         pass  # TODO
 
     def _action_command_response(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
-        relates_to = header.find('a:RelatesTo', WSManPS.NAMESPACES)
-        if relates_to is not None:
-            relates_to = relates_to.text
+        relates_to = WSManPS._find_text(header, WSManPS.PATH_RELATES_TO)
         if relates_to is None or relates_to not in self.command_msgs:
-            self.logger.debug('WS-Man CommandResponse did not look related to PowerShell so ignored due to '
-                              'unrecognised RelatedTo (relates_to: {}, action: {}, activity_id: {}, pid: {}, tid: {}): '
-                              '{}'.format(relates_to, action, activity_id, pid, tid,
-                                          ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man CommandResponse did not look related to PowerShell so ignored due to '
+                                  'unrecognised RelatedTo (relates_to: {}, action: {}, activity_id: {}, pid: {}, '
+                                  'tid: {}): {}'.format(relates_to, action, activity_id, pid, tid,
+                                              ET.tostring(doc, encoding='unicode')))
             return
         # Get the command ID
-        command_id = doc.find('s:Body/rsp:CommandResponse/rsp:CommandId', WSManPS.NAMESPACES)
-        if command_id is not None:
-            command_id = command_id.text
+        command_id = WSManPS._find_text(doc, WSManPS.PATH_COMMAND_ID)
         if command_id is None:
             self.logger.warning('Could not find a CommandId in CommandResponse despite it appearing to be related to a '
                                 'prior PowerShell Command request based on RelatesTo/MessageID match '
@@ -301,69 +350,71 @@ class WSManPS:
         self._track_command_by_id(command_id, shell_id)
 
     def _action_receive_response(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
-        relates_to = header.find('a:RelatesTo', WSManPS.NAMESPACES)
-        if relates_to is not None:
-            relates_to = relates_to.text
+        relates_to = WSManPS._find_text(header, WSManPS.PATH_RELATES_TO)
         if relates_to is None or relates_to not in self.receive_msgs:
-            self.logger.debug('WS-Man ReceiveResponse was not associated with a known PowerShell Receive request, so '
-                              'it will be ignored (relates_to: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(relates_to, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man ReceiveResponse was not associated with a known PowerShell Receive request, '
+                                  'so it will be ignored (relates_to: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(relates_to, activity_id, pid, tid,
+                                            ET.tostring(doc, encoding='unicode')))
             return
         # Remove from receive tracking, capturing shell_id at the same time
         shell_id = self.receive_msgs.pop(relates_to)
-        # Identify any commands which are finished executing
-        commands_finished = {}
-        command_states = doc.findall('s:Body/rsp:ReceiveResponse/rsp:CommandState', WSManPS.NAMESPACES)
-        for cs_elem in command_states:
-            command_id = cs_elem.get('CommandId')
-            exit_code = cs_elem.find('rsp:ExitCode', WSManPS.NAMESPACES)
-            if exit_code is not None:
-                exit_code = exit_code.text  # Note, this will be a string, not an int. Could parse it, but real need.
-            state = cs_elem.get('State')
-            if command_id is not None and (state == WSManPS.CMD_STATE_DONE or exit_code is not None):
-                commands_finished[command_id] = exit_code
-                self.logger.info('Command {} finished with ExitCode: {}'.format(command_id, exit_code))
-        # Parse out streams and pass to PSRP defragmenter
-        streams = doc.findall('s:Body/rsp:ReceiveResponse/rsp:Stream', WSManPS.NAMESPACES)
-        for stream_element in streams:
-            name = stream_element.get('Name')
-            if name is None:
-                name = '<UNKNOWN_STREAM>'
-            # There may not be a CommandId
-            command_id = stream_element.get('CommandId')
-            stream_blob = None
-            try:
-                stream_blob = base64.b64decode(stream_element.text.encode('utf-8'))
-                if command_id is not None:
-                    self.logger.debug('ReceiveResponse for CommandId {}, stream {}'.format(command_id, name))
-                else:
-                    self.logger.debug('ReceiveResponse, stream {}'.format(name))
-            except (ValueError, binascii.Error):
-                tb = traceback.format_exc()
-                if command_id is None:
-                    self.logger.error('Error decoding stream {}: {}'.format(name, tb))
-                else:
-                    self.logger.error('Error decoding stream {} for CommandId {}: {}'.format(name, command_id, tb))
-            if stream_blob is not None:
-                # Decompress the stream data as necessary
-                decompressed_data = self._decompress_stream_data(stream_blob)
-                self.psrp_defrag.new_fragment_data(shell_id, decompressed_data, command_id=command_id)
+        receive_response = doc.find(WSManPS.PATH_RECEIVE_RESPONSE)
+        if receive_response is None:
+            return
+        # Walk the ReceiveResponse once, passing streams to the PSRP defragmenter and identifying any commands which
+        # are finished executing
+        commands_finished = []
+        for child in receive_response:
+            tag = child.tag
+            if tag == WSManPS.TAG_STREAM:
+                name = child.get('Name')
+                if name is None:
+                    name = '<UNKNOWN_STREAM>'
+                # There may not be a CommandId
+                command_id = child.get('CommandId')
+                stream_blob = None
+                try:
+                    stream_blob = WSManPS._b64_decode(child.text)
+                    if command_id is not None:
+                        self.logger.debug('ReceiveResponse for CommandId {}, stream {}'.format(command_id, name))
+                    else:
+                        self.logger.debug('ReceiveResponse, stream {}'.format(name))
+                except (ValueError, binascii.Error):
+                    tb = traceback.format_exc()
+                    if command_id is None:
+                        self.logger.error('Error decoding stream {}: {}'.format(name, tb))
+                    else:
+                        self.logger.error('Error decoding stream {} for CommandId {}: {}'.format(name, command_id, tb))
+                if stream_blob is not None:
+                    # Decompress the stream data as necessary
+                    decompressed_data = self._decompress_stream_data(stream_blob)
+                    self.psrp_defrag.new_fragment_data(shell_id, decompressed_data, command_id=command_id)
+            elif tag == WSManPS.TAG_COMMAND_STATE:
+                command_id = child.get('CommandId')
+                # Note, this will be a string, not an int. Could parse it, but real need.
+                exit_code = WSManPS._find_text(child, WSManPS.PATH_EXIT_CODE)
+                state = child.get('State')
+                if command_id is not None and (state == WSManPS.CMD_STATE_DONE or exit_code is not None):
+                    commands_finished.append(command_id)
+                    self.logger.info('Command {} finished with ExitCode: {}'.format(command_id, exit_code))
         # Remove tracking for finished commands
-        for command_id, exit_code in commands_finished.items():
-            self.commands.pop(command_id)
+        for command_id in commands_finished:
+            self.commands.pop(command_id, None)
 
     def _action_command(self, activity_id, pid, tid, doc, header, action, to, message_id, resource_uri=None):
         # We get shell_id before calling _known_shell_id_or_resource_uri, as we need to capture and use it later
         shell_id = WSManPS._get_shell_id(header)
         if not self._known_shell_id_or_resource_uri(header, resource_uri, action, shell_id=shell_id):
-            self.logger.debug('WS-Man Command was not associated with a known PowerShell Shell or ResourceURI, so it '
-                              'will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(resource_uri, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man Command was not associated with a known PowerShell Shell or ResourceURI, so '
+                                  'it will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(resource_uri, activity_id, pid, tid,
+                                            ET.tostring(doc, encoding='unicode')))
             return
         # Pull out and parse the command details from the Arguments tag
-        arguments = doc.find('s:Body/rsp:CommandLine/rsp:Arguments', WSManPS.NAMESPACES)
-        if arguments is not None:
-            arguments = arguments.text
+        arguments = WSManPS._find_text(doc, WSManPS.PATH_ARGUMENTS)
         if arguments is None:
             self.logger.error('Could not find s:Body/rsp:CommandLine/rsp:Arguments in Command request despite it '
                               'appearing to relate to PowerShell based on ShellId/ResourceURI '
@@ -372,7 +423,7 @@ class WSManPS:
             return
         cmd_blob = None
         try:
-            cmd_blob = base64.b64decode(arguments.encode('utf-8'))
+            cmd_blob = WSManPS._b64_decode(arguments)
         except (ValueError, binascii.Error):
             tb = traceback.format_exc()
             self.logger.error('Error decoding command arguments (activity_id: {}, pid: {}, tid: {}): {} | '
@@ -386,9 +437,11 @@ class WSManPS:
         # We get shell_id before calling _known_shell_id_or_resource_uri, as we need to capture and use it later
         shell_id = WSManPS._get_shell_id(header)
         if not self._known_shell_id_or_resource_uri(header, resource_uri, action, shell_id=shell_id):
-            self.logger.debug('WS-Man Receive was not associated with a known PowerShell Shell or ResourceURI, so it '
-                              'will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
-                              ''.format(resource_uri, activity_id, pid, tid, ET.tostring(doc, encoding='unicode')))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('WS-Man Receive was not associated with a known PowerShell Shell or ResourceURI, so '
+                                  'it will be ignored (resource_uri: {}, activity_id: {}, pid: {}, tid: {}): {}'
+                                  ''.format(resource_uri, activity_id, pid, tid,
+                                            ET.tostring(doc, encoding='unicode')))
             return
         # Track by MessageID to match corresponding ReceiveResponse and keep track of what Shell we are in
         self._track_receive(message_id, header)
@@ -396,7 +449,7 @@ class WSManPS:
         # we grab any CommandIds here in case we missed the previous CommandResponse where we usually first see the
         # CommandId. This gives us a second chance to identify PowerShell related CommandIds, so we can connect commands
         # to their stream outputs.
-        desired_streams = doc.findall('s:Body/rsp:Receive/rsp:DesiredStream', WSManPS.NAMESPACES)
+        desired_streams = doc.findall(WSManPS.PATH_DESIRED_STREAMS)
         for desired_stream in desired_streams:
             command_id = desired_stream.get('CommandId')
             if command_id is not None and command_id not in self.commands:
@@ -411,16 +464,22 @@ class WSManPS:
         #  anyway.
         pass
 
+    # Returns the text of the first element matching path, or None if there is no such element or it has no text.
+    @staticmethod
+    def _find_text(elem, path):
+        return elem.findtext(path) or None
+
+    # Base64 decode the text of an element. Idle Receive streams and retried Commands often carry exactly the same data,
+    # so recent results are cached. Raises binascii.Error (or ValueError) on invalid data, as base64.b64decode() does.
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _b64_decode(text):
+        return base64.b64decode(text)
+
+    # Returns the ShellId from the SelectorSet under elem (a SOAP header or ReferenceParameters), or None if not present
     @staticmethod
-    def _get_shell_id(header):
-        selectors = header.findall('w:SelectorSet/w:Selector', WSManPS.NAMESPACES)
-        shell_id = None
-        for selector in selectors:
-            name = selector.get('Name')
-            if name == 'ShellId':
-                shell_id = selector.text
-                break
-        return shell_id
+    def _get_shell_id(elem):
+        return WSManPS._find_text(elem, WSManPS.PATH_SHELL_ID_SELECTOR)
 
     def _known_shell_id_or_resource_uri(self, header, resource_uri, action, shell_id=None):
         if shell_id is None:
@@ -445,17 +504,13 @@ class WSManPS:
     # (e.g. for tracking Receive requests 'Receive' could be passed).
     def _track_shell_id(self, header, key, tracking_dict, track_name):
         # Pull out the shell_id and track against key in tracking_dict
-        selectors = header.findall('w:SelectorSet/w:Selector', WSManPS.NAMESPACES)
-        for selector in selectors:
-            name = selector.get('Name')
-            if name == 'ShellId':
-                shell_id = selector.text
-                if shell_id is not None and shell_id != '':
-                    # Save this key to tracking_dict, recording the associated shell_id
-                    if key in tracking_dict:
-                        self.logger.warning('Replacing an existing {} tracking entry with key: {}, shell_id will now '
-                                            'be {} (was {})'.format(track_name, key, shell_id, tracking_dict[key]))
-                    tracking_dict[key] = shell_id
+        shell_id = WSManPS._get_shell_id(header)
+        if shell_id is not None:
+            # Save this key to tracking_dict, recording the associated shell_id
+            if key in tracking_dict:
+                self.logger.warning('Replacing an existing {} tracking entry with key: {}, shell_id will now be {} '
+                                    '(was {})'.format(track_name, key, shell_id, tracking_dict[key]))
+            tracking_dict[key] = shell_id
 
     def _track_receive(self, message_id, header):
         self._track_shell_id(header, message_id, self.receive_msgs, 'Receive')
@@ -468,57 +523,110 @@ class WSManPS:
 
     def _track_command_by_id(self, command_id, shell_id):
         if shell_id is not None and shell_id != '':
-            if shell_id in self.commands:
+            if command_id in self.commands:
                 self.logger.warning('Replacing an existing command_id tracking entry. The command_id {} will now be '
                                     'associated with shell_id {} (was {})'.format(command_id, shell_id,
                                                                                   self.commands[command_id]))
+                self.commands.move_to_end(command_id)
             self.commands[command_id] = shell_id
+            if len(self.commands) > WSManPS.MAX_TRACKED_COMMANDS:
+                oldest_command_id, oldest_shell_id = self.commands.popitem(last=False)
+                self.logger.debug('Tracking too many commands, dropping the oldest: command_id {} (shell_id {})'
+                                  ''.format(oldest_command_id, oldest_shell_id))
 
     def _track_create(self, message_id):
-        if message_id not in self.create_msgs:
-            self.create_msgs.append(message_id)
+        self.create_msgs.add(message_id)
 
     def _decompress_stream_data(self, stream_blob):
         if self.libwim is None:
             raise Exception('Cannot decompress as libwim not initialized. Do you have the libwim-15.dll?')
-        # Will contain the fully decompressed data
-        fully_decompressed = bytearray()
-        # Iterate through each compression block in the stream_blob
-        while stream_blob != b'':
+        # Each compression header gives the size of its block once decompressed, so scan the headers first and allocate
+        # the fully decompressed data once. Blocks are then decompressed straight into it.
+        unpack_header = WSManPS.COMPRESSION_HEADER.unpack_from
+        header_len = WSManPS.COMPRESSION_HEADER_LEN
+        blob_len = len(stream_blob)
+        if blob_len >= header_len:
+            uncompressed_size, compressed_size = unpack_header(stream_blob)
+            if uncompressed_size == compressed_size and header_len + compressed_size + 1 == blob_len:
+                # The whole stream is a single block that was not compressed, which is common for small messages. It
+                # only needs the compression header removing, so skip the output buffer and the block loop entirely.
+                return stream_blob[header_len:]
+        total_size = 0
+        offset = 0
+        while offset < blob_len:
+            uncompressed_size, compressed_size = unpack_header(stream_blob, offset)
+            total_size += uncompressed_size + 1
+            offset += header_len + compressed_size + 1
+        fully_decompressed = bytearray(total_size)
+        pos = 0
+        # Walk the compression blocks by offset. Slicing the memoryview gives views rather than copying the rest of the
+        # stream_blob for every block.
+        blob = memoryview(stream_blob)
+        # Compressed blocks are passed to wimlib as a pointer into stream_blob itself, rather than as a bytes copy of
+        # each block. stream_blob is immutable bytes, so wimlib only ever reads through this pointer.
+        blob_address = None
+        offset = 0
+        while offset < blob_len:
             # Decode the compression header
-            uncompressed_size, compressed_size = struct.unpack('<HH', stream_blob[:4])
+            uncompressed_size, compressed_size = unpack_header(blob, offset)
             # Correct for the out-by-one (a known problem in the original Microsoft protocol spec)
             uncompressed_size += 1
             compressed_size += 1
-            # Strip the compression header from the buffer
-            stream_blob = stream_blob[4:]
-            # Grab the block data for this compression block
-            compressed_block = stream_blob[:compressed_size]
+            # Skip over the compression header
+            offset += header_len
             # See if the data was actually compressed or not
             if uncompressed_size != compressed_size:
-                # Block is compressed, so decompress it
-                uncompressed_data_type = ctypes.c_char * uncompressed_size
-                uncompressed_data = uncompressed_data_type()
-                ret = self.libwim.wimlib_decompress(compressed_block, compressed_size, uncompressed_data,
-                                                    uncompressed_size, self.xpress_decompressor)
+                # Block is compressed, so decompress it into its place in the output
+                if blob_address is None:
+                    blob_address = ctypes.cast(stream_blob, ctypes.c_void_p).value
+                block_out = (ctypes.c_char * uncompressed_size).from_buffer(fully_decompressed, pos)
+                ret = self.wimlib_decompress(blob_address + offset, compressed_size, block_out, uncompressed_size,
+                                             self.xpress_decompressor)
                 if ret != 0:
                     self.logger.error('Wimlib xpress decompression failed with return value: {}. Data will be appended '
                                       'to the stream buffer anyway just in case we can proceed, but other errors may '
                                       'occur as a result.'.format(ret))
-                final_block_data = uncompressed_data.raw
+                    # Leave the block zeroed rather than partially decompressed
+                    ctypes.memset(block_out, 0, uncompressed_size)
+                pos += uncompressed_size
             else:
-                # No compression actually took place for this block
-                final_block_data = compressed_block
-            # Append data and advance to next compression block
-            fully_decompressed.extend(final_block_data)
-            stream_blob = stream_blob[compressed_size:]
-        return bytes(fully_decompressed)
+                # No compression actually took place for this block, so copy it into place straight from the view of
+                # the stream_blob, without an intermediate bytes object (it may be short if the stream was truncated)
+                literal_block = blob[offset:offset + compressed_size]
+                block_len = len(literal_block)
+                fully_decompressed[pos:pos + block_len] = literal_block
+                pos += block_len
+            # Advance to next compression block
+            offset += compressed_size
+        if pos != total_size:
+            # Only possible if the stream was truncated
+            fully_decompressed = fully_decompressed[:pos]
+        # Returned without copying to bytes, as the PSRPDefragmenter accepts any bytes-like object. Each call builds a
+        # new bytearray, so it is never modified after being handed on.
+        return fully_decompressed
 
 
 class SoapDefragmenterException(Exception):
     pass
 
 
+class _PartialSoap:
+    """The chunks received so far for a single SOAP message being defragmented by SoapDefragmenter."""
+
+    __slots__ = ('total_chunks', 'last_chunk', 'pid', 'tid', 'soap')
+
+    def __init__(self, total_chunks, pid, tid):
+        self.total_chunks = total_chunks
+        self.last_chunk = 0
+        self.pid = pid
+        self.tid = tid
+        self.soap = []
+
+    def __repr__(self):
+        return ('_PartialSoap(total_chunks={}, last_chunk={}, pid={}, tid={}, soap={!r})'
+                ''.format(self.total_chunks, self.last_chunk, self.pid, self.tid, self.soap))
+
+
 class SoapDefragmenter:
     """This defragments SOAP received from ETW, also providing thread synchronisation.
     (Note this is not the same as defragmentation of PSRP messages).
@@ -540,42 +648,45 @@ class SoapDefragmenter:
         mkey = None
         with self.lock:
             try:
-                if 'ActivityId' not in event['EventHeader']:
-                    activity_id = -1  # Fall back ActivityId in an attempt to handle cases where there isn't one
-                else:
-                    activity_id = event['EventHeader']['ActivityId']
-                pid = event['EventHeader']['ProcessId']
-                tid = event['EventHeader']['ThreadId']
+                header = event['EventHeader']
+                # Fall back ActivityId in an attempt to handle cases where there isn't one
+                activity_id = header.get('ActivityId', -1)
+                pid = header['ProcessId']
+                tid = header['ThreadId']
                 # Make a key for partial_messages combining activity_id, pid and tid
-                mkey = '{}_{}_{}'.format(activity_id, pid, tid)
+                mkey = (activity_id, pid, tid)
                 # Add a new partial_messages record if not seen before
-                if mkey not in self.partial_messages:
-                    self.partial_messages[mkey] = {'total_chunks': int(event['totalChunks']), 'last_chunk': 0,
-                                                   'pid': pid, 'tid': tid, 'soap': ''}
+                partial = self.partial_messages.get(mkey)
+                if partial is None:
+                    partial = _PartialSoap(int(event['totalChunks']), pid, tid)
+                    self.partial_messages[mkey] = partial
                 # Check the chunk index is what we expect
                 chunk_index = int(event['index'])
-                if chunk_index != self.partial_messages[mkey]['last_chunk'] + 1:
+                if chunk_index != partial.last_chunk + 1:
                     raise SoapDefragmenterException('out of order chunk, got index {}, expected {}'
-                                                    ''.format(chunk_index,
-                                                              self.partial_messages[mkey]['last_chunk'] + 1))
+                                                    ''.format(chunk_index, partial.last_chunk + 1))
                 else:
                     self.logger.debug('Processing WS-Man SOAP chunk from ETW: ActivityId: {}, PID: {}, TID: {}, '
                                       'chunk: {} of {}'.format(activity_id, pid, tid, chunk_index,
-                                                               self.partial_messages[mkey]['total_chunks']))
-                    self.partial_messages[mkey]['last_chunk'] += 1
-                    # String concatenation is expensive in Python, but usually only ~1-6 chunks, so not too many
-                    self.partial_messages[mkey]['soap'] += event['SoapDocument']
+                                                               partial.total_chunks))
+                    partial.last_chunk += 1
+                    # Chunks are collected in a list and joined once complete, rather than repeatedly concatenated
+                    partial.soap.append(event['SoapDocument'])
                     # Check if we have the last chunk
-                    if chunk_index == self.partial_messages[mkey]['total_chunks']:
-                        self.logger.info('WS-Man SOAP (Activity ID: {}, PID: {}, TID: {}): '
-                                         '{}'.format(activity_id, pid, tid, self.partial_messages[mkey]['soap']))
-                        self.completed_soap_callback(activity_id, pid, tid, self.partial_messages[mkey]['soap'])
+                    if chunk_index == partial.total_chunks:
+                        soap = ''.join(partial.soap)
+                        if self.logger.isEnabledFor(logging.INFO):
+                            self.logger.info('WS-Man SOAP (Activity ID: {}, PID: {}, TID: {}): '
+                                             '{}'.format(activity_id, pid, tid, soap))
+                        self.completed_soap_callback(activity_id, pid, tid, soap)
                         self.partial_messages.pop(mkey)
             except Exception:
-                tb = traceback.format_exc()
-                self.logger.error('SoapDefragmener error: soap message will be abandoned. self.partial_messages: {} | '
-                                  'event: {} | Exception info: {}'
-                                  ''.format(self.partial_messages, event, tb))
+                # The traceback is added by the logging framework, and only formatted if the record is emitted
+                self.logger.exception('SoapDefragmener error: soap message will be abandoned. event: {}'.format(event))
+                # All of the partial messages can be large, so they are only formatted when debugging
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('SoapDefragmener partial messages at time of error: {}'
+                                      ''.format(self.partial_messages))
                 # Drop any data for this SOAP message
                 if mkey and mkey in self.partial_messages:
                     self.partial_messages.pop(mkey)